@@ -3,13 +3,12 @@ import sqlite3
 import functools
 import os
 import subprocess
-from time import sleep
-from tqdm import tqdm
+import time
 
-from typing import List, Dict, Union, Iterable, Optional, Tuple
+from typing import List, Iterable, Optional, Tuple
 
 
-SqliteQueryType = List[Dict[str, Union[str, int, float, None]]]
+SqliteQueryType = Iterable[sqlite3.Row]
 
 DEFAULT_ANNOTATION_DB_DIRS = [
     pathlib.Path.home()
@@ -26,11 +25,25 @@ DEFAULT_BOOK_DB_DIRS = [
 
 BOOKS_APP_NAME = "Books"
 
+SYNC_POLL_INTERVAL = 0.25
+SYNC_SETTLE_TIME = 2.0
+
+READONLY_SCHEMA_PRAGMAS = [
+    "PRAGMA {schema}.mmap_size = 268435456",
+    "PRAGMA {schema}.cache_size = -65536",
+]
+
 
 ATTACH_BOOKS_QUERY = """
 attach database ? as books
 """
 
+NOTE_COLUMNS_QUERY = """
+select 'annotation', name from pragma_table_info('ZAEANNOTATION', 'main')
+union all
+select 'book', name from pragma_table_info('ZBKLIBRARYASSET', 'books')
+"""
+
 
 NOTE_LIST_FIELDS = [
     "asset_id",
@@ -45,6 +58,18 @@ NOTE_LIST_FIELDS = [
     "modified_date",
 ]
 
+_NOTE_SELECT_TEMPLATE = ", ".join(
+    f"{{{field}}} as {field}" for field in NOTE_LIST_FIELDS
+)
+
+_NOTE_QUERY_TEMPLATE = """
+select {select_list}
+from ZAEANNOTATION
+{join_clause}
+where {where_clause}
+order by {order_by};
+"""
+
 ANNOTATION_COLUMN_ALIASES = {
     "asset_id": ["ZANNOTATIONASSETID", "ZASSETID"],
     "location": ["ZANNOTATIONLOCATION", "ZLOCATION", "ZANNOTATIONLOCATIONSTRING"],
@@ -80,13 +105,67 @@ def _dir_env_override(env_key: str) -> Optional[pathlib.Path]:
     return pathlib.Path(value).expanduser()
 
 
+def _annotation_dirs() -> List[pathlib.Path]:
+    override = _dir_env_override("APPLE_BOOKS_ANNOTATION_DB_DIR")
+    return [override] if override else DEFAULT_ANNOTATION_DB_DIRS
+
+
+def _book_dirs() -> List[pathlib.Path]:
+    override = _dir_env_override("APPLE_BOOKS_BOOK_DB_DIR")
+    return [override] if override else DEFAULT_BOOK_DB_DIRS
+
+
+def _latest_mtime(files: Iterable[pathlib.Path]) -> float:
+    latest = 0.0
+    for path in files:
+        # Books writes through the write-ahead log first
+        for candidate in (str(path), f"{path}-wal"):
+            try:
+                latest = max(latest, os.stat(candidate).st_mtime)
+            except FileNotFoundError:
+                continue
+    return latest
+
+
+def _wait_for_sync(files: List[pathlib.Path], max_wait: float) -> None:
+    start = time.monotonic()
+    initial_mtime = last_mtime = _latest_mtime(files)
+    last_change = start
+
+    while time.monotonic() - start < max_wait:
+        time.sleep(SYNC_POLL_INTERVAL)
+        now = time.monotonic()
+        mtime = _latest_mtime(files)
+        if mtime != last_mtime:
+            last_mtime = mtime
+            last_change = now
+        elif last_mtime != initial_mtime and now - last_change > SYNC_SETTLE_TIME:
+            # Books has written and gone quiet again
+            return
+
+
 def _iter_sqlite_files(dirs: Iterable[pathlib.Path]) -> List[pathlib.Path]:
-    files: List[pathlib.Path] = []
+    files: List[Tuple[float, str]] = []
     for directory in dirs:
-        if directory.is_dir():
-            files.extend(list(directory.glob("*.sqlite")))
-    files.sort(key=lambda p: p.stat().st_mtime, reverse=True)
-    return files
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".sqlite") and entry.is_file():
+                        files.append((entry.stat().st_mtime, entry.path))
+        except OSError:
+            continue
+    files.sort(key=lambda f: f[0], reverse=True)
+    return [pathlib.Path(p) for _, p in files]
+
+
+def _readonly_uri(path: pathlib.Path) -> str:
+    # immutable=1 is deliberately not used: Books keeps recent changes in the
+    # -wal file, which sqlite ignores for immutable databases
+    return f"{path.resolve().as_uri()}?mode=ro"
+
+
+def _connect_readonly(path: pathlib.Path) -> sqlite3.Connection:
+    return sqlite3.connect(_readonly_uri(path), uri=True, check_same_thread=False)
 
 
 def _table_exists(
@@ -106,42 +185,49 @@ def _table_exists(
     return cur.fetchone() is not None
 
 
-def _get_table_columns(
-    conn: sqlite3.Connection, table: str, schema: Optional[str] = None
-) -> List[str]:
-    cur = conn.cursor()
-    if schema:
-        cur.execute(f"PRAGMA {schema}.table_info({table})")
-    else:
-        cur.execute(f"PRAGMA table_info({table})")
-    return [row[1] for row in cur.fetchall()]
+def _get_note_columns(
+    conn: sqlite3.Connection,
+) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    annotation_columns: List[str] = []
+    book_columns: List[str] = []
+    for source, name in conn.execute(NOTE_COLUMNS_QUERY):
+        if source == "annotation":
+            annotation_columns.append(name)
+        else:
+            book_columns.append(name)
+    return tuple(annotation_columns), tuple(book_columns)
 
 
-def _pick_column(available: List[str], candidates: List[str]) -> Optional[str]:
+def _pick_column(available: Iterable[str], candidates: List[str]) -> Optional[str]:
     for col in candidates:
         if col in available:
             return col
     return None
 
 
-def _find_db_file(candidates: List[pathlib.Path], required_table: str) -> pathlib.Path:
+def _find_db_file(
+    candidates: List[pathlib.Path], required_table: str
+) -> Tuple[pathlib.Path, sqlite3.Connection]:
     if not candidates:
         raise FileNotFoundError("No sqlite files found in expected directories")
     for path in candidates:
         try:
-            conn = sqlite3.connect(str(path))
-            if _table_exists(conn, required_table):
-                conn.close()
-                return path
-            conn.close()
+            conn = _connect_readonly(path)
         except sqlite3.Error:
             continue
+        try:
+            if _table_exists(conn, required_table):
+                return path, conn
+        except sqlite3.Error:
+            pass
+        conn.close()
     raise FileNotFoundError(f"No sqlite files contained table {required_table}")
 
 
+@functools.lru_cache(maxsize=4)
 def _build_note_query(
-    annotation_columns: List[str],
-    book_columns: List[str],
+    annotation_columns: Tuple[str, ...],
+    book_columns: Tuple[str, ...],
 ) -> Tuple[str, List[str]]:
     asset_id_col = _pick_column(
         annotation_columns, ANNOTATION_COLUMN_ALIASES["asset_id"]
@@ -197,18 +283,18 @@ def _build_note_query(
     def select_or_null(col: Optional[str]) -> str:
         return f"ZAEANNOTATION.{col}" if col else "NULL"
 
-    select_columns = [
-        f"ZAEANNOTATION.{asset_id_col} as asset_id",
-        f"{title_expr} as title",
-        f"{author_expr} as author",
-        f"{select_or_null(location_col)} as location",
-        f"{select_or_null(selected_text_col)} as selected_text",
-        f"{select_or_null(note_col)} as note",
-        f"{select_or_null(represent_col)} as represent_text",
-        f"{select_or_null(chapter_col)} as chapter",
-        f"{select_or_null(style_col)} as style",
-        f"{select_or_null(modified_col)} as modified_date",
-    ]
+    select_exprs = {
+        "asset_id": f"ZAEANNOTATION.{asset_id_col}",
+        "title": title_expr,
+        "author": author_expr,
+        "location": select_or_null(location_col),
+        "selected_text": select_or_null(selected_text_col),
+        "note": select_or_null(note_col),
+        "represent_text": select_or_null(represent_col),
+        "chapter": select_or_null(chapter_col),
+        "style": select_or_null(style_col),
+        "modified_date": select_or_null(modified_col),
+    }
 
     where_clauses = [
         f"ZAEANNOTATION.{asset_id_col} IS NOT NULL",
@@ -230,62 +316,76 @@ def _build_note_query(
     if text_filters:
         where_clauses.append("(" + " OR ".join(text_filters) + ")")
 
+    # Book.annotations re-sorts by parsed location with a stable sort, so this
+    # secondary key decides the order of annotations whose locations tie
     order_expr = location_sort_col or location_col or modified_col or asset_id_col
-    order_by = f"order by ZAEANNOTATION.{asset_id_col}"
-    if order_expr:
-        order_by += f", ZAEANNOTATION.{order_expr}"
-
-    query = "\n".join(
-        [
-            "select",
-            ", ".join(select_columns),
-            "from ZAEANNOTATION",
-            join_clause,
-            "where " + " and ".join(where_clauses),
-            order_by + ";",
-        ]
+    order_by = f"ZAEANNOTATION.{asset_id_col}, ZAEANNOTATION.{order_expr}"
+
+    query = _NOTE_QUERY_TEMPLATE.format_map(
+        {
+            "select_list": _NOTE_SELECT_TEMPLATE.format_map(select_exprs),
+            "join_clause": join_clause,
+            "where_clause": " and ".join(where_clauses),
+            "order_by": order_by,
+        }
     )
     return query, NOTE_LIST_FIELDS
 
 
-@functools.lru_cache(maxsize=1)
-def get_ibooks_database() -> sqlite3.Cursor:
-    annotation_override = _dir_env_override("APPLE_BOOKS_ANNOTATION_DB_DIR")
-    book_override = _dir_env_override("APPLE_BOOKS_BOOK_DB_DIR")
+_CONN: Optional[sqlite3.Connection] = None
+_CURSOR: Optional[sqlite3.Cursor] = None
+# columns of the currently open databases; reset together with _CONN
+_NOTE_COLUMNS: Optional[Tuple[Tuple[str, ...], Tuple[str, ...]]] = None
 
-    annotation_dirs = (
-        [annotation_override] if annotation_override else DEFAULT_ANNOTATION_DB_DIRS
-    )
-    book_dirs = [book_override] if book_override else DEFAULT_BOOK_DB_DIRS
 
-    annotation_files = _iter_sqlite_files(annotation_dirs)
-    book_files = _iter_sqlite_files(book_dirs)
+def get_ibooks_database(invalidate: bool = False) -> sqlite3.Cursor:
+    global _CONN, _CURSOR, _NOTE_COLUMNS
 
-    annotation_file = _find_db_file(annotation_files, "ZAEANNOTATION")
-    book_file = _find_db_file(book_files, "ZBKLIBRARYASSET")
+    if invalidate and _CONN is not None:
+        _CONN.close()
+        _CONN = None
+        _CURSOR = None
+        _NOTE_COLUMNS = None
+    if _CURSOR is not None:
+        return _CURSOR
 
-    db1 = sqlite3.connect(str(annotation_file), check_same_thread=False)
-    cursor = db1.cursor()
-    cursor.execute(ATTACH_BOOKS_QUERY, (str(book_file),))
+    annotation_files = _iter_sqlite_files(_annotation_dirs())
+    book_files = _iter_sqlite_files(_book_dirs())
+
+    _, db1 = _find_db_file(annotation_files, "ZAEANNOTATION")
+    book_file, book_conn = _find_db_file(book_files, "ZBKLIBRARYASSET")
+    book_conn.close()
 
+    db1.row_factory = sqlite3.Row
+    cursor = db1.cursor()
+    cursor.execute(ATTACH_BOOKS_QUERY, (_readonly_uri(book_file),))
+    for schema in ("main", "books"):
+        for pragma in READONLY_SCHEMA_PRAGMAS:
+            cursor.execute(pragma.format(schema=schema))
+    cursor.execute("PRAGMA temp_store = MEMORY")
+
+    _CONN = db1
+    _CURSOR = cursor
     return cursor
 
 
 def fetch_annotations(refresh: bool, sleep_time: int = 20) -> SqliteQueryType:
+    global _NOTE_COLUMNS
+
     if refresh:
+        watched = _iter_sqlite_files(_annotation_dirs())
         subprocess.run(["open", "-a", BOOKS_APP_NAME], check=False)
         print("Refreshing database...")
-        for _ in tqdm(range(sleep_time)):
-            sleep(1)
+        _wait_for_sync(watched, sleep_time)
         subprocess.run(["osascript", "-e", f'quit app "{BOOKS_APP_NAME}"'], check=False)
 
-    cur = get_ibooks_database()
+    cur = get_ibooks_database(invalidate=refresh)
     conn = cur.connection
-    annotation_columns = _get_table_columns(conn, "ZAEANNOTATION")
-    book_columns = _get_table_columns(conn, "ZBKLIBRARYASSET", schema="books")
-    note_query, fields = _build_note_query(annotation_columns, book_columns)
-    exe = cur.execute(note_query)
-    res = exe.fetchall()
-    annos = [dict(zip(fields, r)) for r in res]
-
-    return annos
+    if _NOTE_COLUMNS is None:
+        _NOTE_COLUMNS = _get_note_columns(conn)
+    annotation_columns, book_columns = _NOTE_COLUMNS
+    note_query, _ = _build_note_query(annotation_columns, book_columns)
+
+    # rows are streamed to the caller; a dedicated cursor keeps a later
+    # call on the shared cursor from resetting an iteration in progress
+    return conn.cursor().execute(note_query)
@@ -1,16 +1,18 @@
+import os
 import re
 import pathlib
 import datetime as dt
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import frontmatter
-from typing import List, Dict, Optional, Union, Any, Callable
+from typing import List, Dict, DefaultDict, Optional, Union, Any, Callable
 from dateutil import parser as duparser
 from slugify import slugify
 
 from apple_books_highlights.util import (
-    cmp_to_key,
-    query_compare_no_asset_id,
-    TEMPLATE_ENVIRONMENT,
+    parse_location,
+    MARKDOWN_TEMPLATE,
     NS_TIME_INTERVAL_SINCE_1970,
 )
 from apple_books_highlights.booksdb import SqliteQueryType
@@ -19,12 +21,34 @@ from apple_books_highlights.booksdb import SqliteQueryType
 MAX_FILENAME_LEN = 200
 FALLBACK_TITLE_PREFIX = "Untitled"
 FALLBACK_AUTHOR = "Unknown"
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+READER_NOTES_ANCHOR = """<a name="my_notes_dont_delete"></a>"""
+APPLE_BOOKS_NOTES_ANCHOR = """<a name="apple_books_notes_dont_delete"></a>"""
+
+# the line boundaries str.splitlines() recognises
+_LINE_BREAK_CHARS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+_LINE_BREAK_RE = re.compile(r"\r\n|[" + _LINE_BREAK_CHARS + "]")
+
+# control characters that are not allowed in YAML scalars
+_YAML_CTRL_TABLE = dict.fromkeys(
+    list(range(0x00, 0x09)) + [0x0B, 0x0C] + list(range(0x0E, 0x20)), None
+)
 
 
 class BookMetadataError(Exception):
     pass
 
 
+# str/isinstance are bound as defaults so the per-row calls skip global lookups
+def _str_or_none(
+    value: Any, _str: type = str, _isinstance: Callable = isinstance
+) -> Optional[str]:
+    if not value:
+        return None
+    return value if _isinstance(value, _str) else _str(value)
+
+
 class Annotation(object):
     def __init__(
         self,
@@ -41,6 +65,7 @@ class Annotation(object):
 
         stripspaces = lambda x: x.strip() if x else x
         self.location = location
+        self._loc_key = tuple(parse_location(location))
         self.selected_text = stripspaces(selected_text)
 
         self.represent_text = stripspaces(represent_text)
@@ -105,36 +130,39 @@ class Book(object):
 
         self._reader_notes = ""
 
-        reader_notes_start = None
-        apple_books_notes_start = None
-
-        prev_content_lines = self._prev_content.splitlines()
-
-        for i, line in enumerate(prev_content_lines):
-            if """<a name="my_notes_dont_delete"></a>""" in line:
-                reader_notes_start = i
-            if """<a name="apple_books_notes_dont_delete"></a>""" in line:
-                apple_books_notes_start = i
+        content = self._prev_content
+        reader_idx = content.rfind(READER_NOTES_ANCHOR)
+        apple_idx = content.rfind(APPLE_BOOKS_NOTES_ANCHOR)
 
         # if not present, abort
-        if reader_notes_start is None and apple_books_notes_start is None:
+        if reader_idx == -1 and apple_idx == -1:
             return
 
+        def line_start(idx: int) -> int:
+            return max(content.rfind(ch, 0, idx) for ch in _LINE_BREAK_CHARS) + 1
+
+        def line_end(idx: int) -> int:
+            match = _LINE_BREAK_RE.search(content, idx)
+            return len(content) if match is None else match.end()
+
         # if same line, that's not good
-        if reader_notes_start == apple_books_notes_start:
+        if (
+            reader_idx != -1
+            and apple_idx != -1
+            and line_start(reader_idx) == line_start(apple_idx)
+        ):
             raise BookMetadataError("Note section identifiers on same line")
 
         # if different line, select the appropriate portion of the content
-        if reader_notes_start is None:
-            reader_lines = prev_content_lines[3:apple_books_notes_start]
-        elif reader_notes_start < apple_books_notes_start:
-            reader_lines = prev_content_lines[
-                reader_notes_start + 1 : apple_books_notes_start
-            ]
+        if reader_idx == -1:
+            head = content[: line_start(apple_idx)]
+            reader_text = "\n".join(head.splitlines()[3:])
+        elif apple_idx == -1 or reader_idx > apple_idx:
+            reader_text = content[line_end(reader_idx) :]
         else:
-            reader_lines = prev_content_lines[reader_notes_start + 1 :]
+            reader_text = content[line_end(reader_idx) : line_start(apple_idx)]
 
-        self._reader_notes = "\n".join(reader_lines).strip()
+        self._reader_notes = "\n".join(reader_text.splitlines()).strip()
 
     def __str__(self) -> str:
         asset_id = self._asset_id[:8].ljust(8)
@@ -144,8 +172,7 @@ class Book(object):
         return f"{asset_id} {mod} {self.num_annotations}\t{self._title}"
 
     def _yaml_str(cls, txt: str) -> str:
-        cleaned = re.sub(r"[\x00-\x08\x0b\x0c\x0e-\x1f]", "", txt)
-        return cleaned.strip()
+        return txt.translate(_YAML_CTRL_TABLE).strip()
 
     def _build_filename(self, title: str) -> str:
         asset_id = self._asset_id[:8].lower()
@@ -237,8 +264,7 @@ class Book(object):
 
     @annotations.setter
     def annotations(self, anno: List[Annotation]) -> None:
-        self._annotations = anno
-        self._annotations.sort(key=cmp_to_key(query_compare_no_asset_id))
+        self._annotations = sorted(anno, key=lambda a: a._loc_key)
 
     @property
     def num_annotations(self) -> int:
@@ -250,11 +276,9 @@ class Book(object):
 
     @property
     def content(self) -> str:
-        template = TEMPLATE_ENVIRONMENT.get_template("markdown_template.md")
-
         # print(self._reader_notes[:1000])
 
-        md = template.render(
+        md = MARKDOWN_TEMPLATE.render(
             title=self._title,
             author=self._author,
             highlights=self.annotations,
@@ -266,12 +290,18 @@ class Book(object):
         if not path.is_dir():
             raise NotADirectoryError(f"{str(path)} is not a directory")
 
+        if self._announce_write():
+            self._write_file(path)
+
+    def _announce_write(self) -> bool:
         if not self._sync_notes:
             print("sync locked for", self._title)
-            return
+            return False
 
         print("updating", self._title)
+        return True
 
+    def _write_file(self, path: pathlib.Path) -> None:
         mod_dates = [
             anno.modified_date for anno in self._annotations if anno.modified_date
         ]
@@ -286,11 +316,15 @@ class Book(object):
             modified_date=mod_date_str,
         )
 
-        fn = path / self._filename
+        data = frontmatter.dumps(fmpost).encode("utf-8")
+        (path / self._filename).write_bytes(data)
+
 
-        with open(fn, "w") as f:
-            s = frontmatter.dumps(fmpost)
-            f.write(s)
+def _safe_load_book(filename: pathlib.Path) -> Optional[Book]:
+    try:
+        return Book(filename=filename)
+    except BookMetadataError:
+        return None
 
 
 class BookList(object):
@@ -305,15 +339,18 @@ class BookList(object):
             self.books = self._load_books(self._path)
 
     def _load_books(self, path: pathlib.Path) -> Dict[str, Book]:
-        book_files = path.glob("*.md")
+        with os.scandir(path) as it:
+            book_files = [
+                pathlib.Path(e.path)
+                for e in it
+                if e.name.endswith(".md") and e.is_file()
+            ]
 
         md_books = {}
-        for bf in book_files:
-            try:
-                book = Book(filename=bf)
-                md_books[book.asset_id] = book
-            except BookMetadataError:
-                pass
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as ex:
+            for book in ex.map(_safe_load_book, book_files):
+                if book is not None:
+                    md_books[book.asset_id] = book
 
         return md_books
 
@@ -325,37 +362,34 @@ class BookList(object):
         return self.books[asset_id]
 
     def populate_annotations(self, annos: SqliteQueryType) -> None:
-        res = [
-            r
-            for r in annos
-            if r["asset_id"] is not None
-            and ((r["selected_text"] is not None) or (r["note"] is not None))
-        ]
-
-        for r in res:
-            book = self._get_create_book(str(r["asset_id"]))
-            if book.can_update_title():
-                title = r.get("title")
-                book.title = str(title) if title else None
-            if book.can_update_author():
-                author = r.get("author")
-                book.author = str(author) if author else None
+        anno_group: DefaultDict[str, List[Annotation]] = defaultdict(list)
+        for r in annos:
+            if r["asset_id"] is None or (
+                r["selected_text"] is None and r["note"] is None
+            ):
+                continue
 
-        anno_group: Dict[str, List[Annotation]] = {}
-        for r in res:
             asset_id = str(r["asset_id"])
             if asset_id not in anno_group:
-                anno_group[asset_id] = []
+                book = self._get_create_book(asset_id)
+            else:
+                book = self.books[asset_id]
+            # the library join can match several rows per asset; keep looking
+            # until one of them carries a real title/author
+            if book.can_update_title():
+                book.title = _str_or_none(r["title"])
+            if book.can_update_author():
+                book.author = _str_or_none(r["author"])
 
-            location = str(r["location"]) if r["location"] else None
-            selected_text = str(r["selected_text"]) if r["selected_text"] else None
-            note = str(r["note"]) if r["note"] else None
-            represent_text = str(r["represent_text"]) if r["represent_text"] else None
-            chapter = str(r["chapter"]) if r["chapter"] else None
-            style = str(r["style"]) if r["style"] else None
+            location = _str_or_none(r["location"])
+            selected_text = _str_or_none(r["selected_text"])
+            note = _str_or_none(r["note"])
+            represent_text = _str_or_none(r["represent_text"])
+            chapter = _str_or_none(r["chapter"])
+            style = _str_or_none(r["style"])
 
             modified_date = None
-            if r.get("modified_date") is not None:
+            if r["modified_date"] is not None:
                 try:
                     modified_date = dt.datetime.fromtimestamp(
                         NS_TIME_INTERVAL_SINCE_1970 + float(r["modified_date"])
@@ -363,16 +397,17 @@ class BookList(object):
                 except (TypeError, ValueError):
                     modified_date = None
 
-            anno = Annotation(
-                location=location,
-                selected_text=selected_text,
-                note=note,
-                represent_text=represent_text,
-                chapter=chapter,
-                style=style,
-                modified_date=modified_date,
+            anno_group[asset_id].append(
+                Annotation(
+                    location=location,
+                    selected_text=selected_text,
+                    note=note,
+                    represent_text=represent_text,
+                    chapter=chapter,
+                    style=style,
+                    modified_date=modified_date,
+                )
             )
-            anno_group[asset_id].append(anno)
 
         for asset_id, anno_itr in anno_group.items():
             self.books[asset_id].annotations = anno_itr
@@ -392,7 +427,20 @@ class BookList(object):
 
         path.mkdir(parents=True, exist_ok=True)
 
+        # report on the main thread so the output stays in book order; books
+        # that map to the same file are written in order by a single worker so
+        # the last one wins, as with a sequential loop
+        pending: DefaultDict[pathlib.Path, List[Book]] = defaultdict(list)
         for book in self.books.values():
             if (not book.is_modified) and (not force):
                 continue
-            book.write(path)
+            if book._announce_write():
+                pending[path / book._filename].append(book)
+
+        def write_target(books: List[Book]) -> None:
+            for book in books:
+                book._write_file(path)
+
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as ex:
+            # consume the results so errors from a write are raised here
+            list(ex.map(write_target, pending.values()))
@@ -75,7 +75,6 @@ setup(
         'python-frontmatter>=0.3.1',
         'python-slugify>=1.2.4',
         'click>=6.7',
-        'tqdm>=4.62.2'
     ],
 
     # List additional groups of dependencies here (e.g. development